@@ -2,32 +2,61 @@
 import numpy as np
 import os
 import math
+import threading
 import cv2
 
 import rospy
 import yaml
+try:
+    from yaml import CSafeLoader as YamlSafeLoader  # libyaml-backed, much faster
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
 from sensor_msgs.msg import CompressedImage
 from cv_bridge import CvBridge, CvBridgeError
 from dt_apriltags import Detector
+from turbojpeg import TurboJPEG, TJPF_GRAY
+import intrinsics
 import rospkg
 
 from std_msgs.msg import Int32, String
 from duckietown.dtros import DTROS, TopicType, NodeType
 from duckietown_msgs.msg import AprilTagDetectionArray, AprilTagDetection
 from geometry_msgs.msg import Transform, Vector3, Quaternion
-import tf
 
 
 HOST_NAME = os.environ["VEHICLE_NAME"]
 IGNORE_DISTANCE_MAX = .85
 IGNORE_DISTANCE_MIN = .0
+TAG_SIZE = 0.065  # in meters
 DEBUG = True
 
 
-def _matrix_to_quaternion(r):
-    T = np.array(((0, 0, 0, 0), (0, 0, 0, 0), (0, 0, 0, 0), (0, 0, 0, 1)), dtype=np.float64)
-    T[0:3, 0:3] = r
-    return tf.transformations.quaternion_from_matrix(T)
+def _matrices_to_quaternions(rs):
+    """
+    Converts a batch of (N, 3, 3) rotation matrices to an (N, 4) array of
+    quaternions as (x, y, z, w) rows in one vectorized pass (Shepperd's
+    method), instead of looping over the detections in python.
+    """
+    r00, r11, r22 = rs[:, 0, 0], rs[:, 1, 1], rs[:, 2, 2]
+    # candidate magnitudes 4w^2, 4x^2, 4y^2, 4z^2; the largest one is the
+    # numerically stable component to recover first
+    cand = np.stack((1.0 + r00 + r11 + r22,
+                     1.0 + r00 - r11 - r22,
+                     1.0 - r00 + r11 - r22,
+                     1.0 - r00 - r11 + r22))
+    case = np.argmax(cand, axis=0)
+    s0, s1, s2, s3 = 2.0 * np.sqrt(np.maximum(cand, 1e-12))
+    a = rs[:, 2, 1] - rs[:, 1, 2]
+    b = rs[:, 0, 2] - rs[:, 2, 0]
+    c = rs[:, 1, 0] - rs[:, 0, 1]
+    d = rs[:, 0, 1] + rs[:, 1, 0]
+    e = rs[:, 0, 2] + rs[:, 2, 0]
+    f = rs[:, 1, 2] + rs[:, 2, 1]
+    quats = np.stack((np.stack((a / s0, b / s0, c / s0, 0.25 * s0), axis=1),
+                      np.stack((0.25 * s1, d / s1, e / s1, a / s1), axis=1),
+                      np.stack((d / s2, 0.25 * s2, f / s2, b / s2), axis=1),
+                      np.stack((e / s3, f / s3, 0.25 * s3, c / s3), axis=1)))
+    return quats[case, np.arange(rs.shape[0])]
 
 
 class MLNode(DTROS):
@@ -37,24 +66,51 @@ class MLNode(DTROS):
         rospack = rospkg.RosPack()
         self.seq = 0
         self.intrinsic = self.readYamlFile(rospack.get_path('apriltag_node') + '/src/camera_intrinsic.yaml')
+        self.jpeg = TurboJPEG()
+
+        # the calibration is fixed, so solve the undistortion mapping once and
+        # only pay for a cv2.remap per frame instead of a full cv2.undistort
+        self.map1, self.map2 = intrinsics.get_maps()
+        camera_matrix = np.array(self.intrinsic["camera_matrix"]["data"]).reshape(3, 3)
+        self.fx = camera_matrix[0][0].item()
+        self.fy = camera_matrix[1][1].item()
+        self.cx = camera_matrix[0][2].item()
+        self.cy = camera_matrix[1][2].item()
+        self.camera_params = (self.fx, self.fy, self.cx, self.cy)
+
+        # the only consumer in this project (parking_node) reads tag_id and
+        # the transform, so the homography/center/corners lists are only
+        # packed when a consumer actually asks for them
+        self.publish_tag_geometry = rospy.get_param('~publish_tag_geometry', False)
+        # quad_decimate=2.0 quarters the quad-detection work; tags past
+        # IGNORE_DISTANCE_MAX get ignored anyway so the lost far-field
+        # resolution does not matter
         self.detector = Detector(searchpath=['apriltags'],
                        families='tag36h11',
-                       nthreads=1,
-                       quad_decimate=1.0,
+                       nthreads=2,
+                       quad_decimate=2.0,
                        quad_sigma=0.0,
                        refine_edges=1,
                        decode_sharpening=0.25,
                        debug=0)
-        self.timer = 0
-
-        self.camera_sub = rospy.Subscriber(f'/{HOST_NAME}/camera_node/image/compressed', CompressedImage, self.callback)
-        self.general_sub = rospy.Subscriber('/general', String, self.general_callback)
-
+        # publishers must exist before the first frame can reach the worker
         self.tag_pub = rospy.Publisher(f'/{HOST_NAME}/detected_tagid', Int32, queue_size=10)
         self.tag_distance_pub = rospy.Publisher(f'/{HOST_NAME}/detected_tag_distance', String, queue_size=10)
         self.detections_pub = rospy.Publisher(f'/{HOST_NAME}/apriltag_detector_node/detections', AprilTagDetectionArray,
                                               queue_size=2)
 
+        # detection is too slow to run inline on the subscriber thread; the
+        # callback only stores the newest frame and a single worker consumes
+        # it (latest-wins, stale frames are simply overwritten)
+        self._latest = None
+        self._cond = threading.Condition()
+        self._worker = threading.Thread(target=self.detect_loop, daemon=True)
+        self._worker.start()
+
+        self.camera_sub = rospy.Subscriber(f'/{HOST_NAME}/camera_node/image/compressed', CompressedImage, self.callback,
+                                           queue_size=1, buff_size=2**20)
+        self.general_sub = rospy.Subscriber('/general', String, self.general_callback)
+
     def general_callback(self, msg):
         if msg.data == 'shutdown':
             rospy.signal_shutdown('received shutdown message')
@@ -79,59 +135,70 @@ class MLNode(DTROS):
             self.tag_pub.publish(Int32(id))
     
     def callback(self, msg):
+        # only remember the newest frame; the worker picks it up when it is
+        # done with the previous one, so stale frames are dropped, not queued
+        with self._cond:
+            self._latest = msg
+            self._cond.notify()
+
+    def detect_loop(self):
+        while not rospy.is_shutdown():
+            with self._cond:
+                while self._latest is None:
+                    self._cond.wait(timeout=1.0)
+                    if rospy.is_shutdown():
+                        return
+                msg = self._latest
+                self._latest = None
+            try:
+                self.process_image(msg)
+            except Exception as exc:
+                # a bad frame (e.g. truncated JPEG) must not kill the worker;
+                # rospy used to swallow these in the callback dispatcher
+                rospy.logerr(f'apriltag processing failed on a frame: {exc}')
+
+    def process_image(self, msg):
         # how to decode compressed image
         # reference: http://wiki.ros.org/rospy_tutorials/Tutorials/WritingImagePublisherSubscriber
-        self.timer += 1
-        if self.timer % 8 == 0:
-            compressed_image = np.frombuffer(msg.data, np.uint8)
-            im = cv2.imdecode(compressed_image, cv2.IMREAD_COLOR)
-
-            camera_matrix = np.array(self.intrinsic["camera_matrix"]["data"]).reshape(3,3)
-            camera_proj_mat = np.concatenate((camera_matrix, np.zeros((3, 1), dtype=np.float32)), axis=1)
-            distort_coeff = np.array(self.intrinsic["distortion_coefficients"]["data"]).reshape(5,1)
-            fx = camera_matrix[0][0].item()
-            fy = camera_matrix[1][1].item()
-            cx = camera_matrix[0][2].item()
-            cy = camera_matrix[1][2].item()
-            tag_size = 0.065  # in meters
-
-            width = im.shape[1]
-            height = im.shape[0]
-
-            newmatrix, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, distort_coeff, (width,height), 1, (width,height))
-            undistort_im = cv2.undistort(im, camera_matrix, distort_coeff, None, newmatrix)
-            input_image = cv2.cvtColor(undistort_im, cv2.COLOR_BGR2GRAY)
-            detected_tags = self.detector.detect(input_image, estimate_tag_pose=True, camera_params=(fx, fy, cx, cy), tag_size=tag_size)
-
-            # pack detections into a message
-            tags_msg = AprilTagDetectionArray()
-            tags_msg.header.stamp = msg.header.stamp
-            tags_msg.header.frame_id = msg.header.frame_id
-            for tag in detected_tags:
-                # turn rotation matrix into quaternion
-                q = _matrix_to_quaternion(tag.pose_R)
-                p = tag.pose_t.T[0]
-                # create single tag detection object
-                detection = AprilTagDetection(
-                    transform=Transform(
-                        translation=Vector3(x=p[0], y=p[1], z=p[2]),
-                        rotation=Quaternion(x=q[0], y=q[1], z=q[2], w=q[3]),
-                    ),
-                    tag_id=tag.tag_id,
-                    tag_family=str(tag.tag_family),
-                    hamming=tag.hamming,
-                    decision_margin=tag.decision_margin,
-                    homography=tag.homography.flatten().astype(np.float32).tolist(),
-                    center=tag.center.tolist(),
-                    corners=tag.corners.flatten().tolist(),
-                    pose_error=tag.pose_err,
-                )
-                # add detection to array
-                tags_msg.detections.append(detection)
-            # publish detections
-            self.detections_pub.publish(tags_msg)
-
-            self.process_tags(detected_tags)
+        # decode straight to grayscale; the detector only needs gray anyway
+        im = self.jpeg.decode(msg.data, pixel_format=TJPF_GRAY)[:, :, 0]
+
+        input_image = cv2.remap(im, self.map1, self.map2, cv2.INTER_LINEAR)
+        detected_tags = self.detector.detect(input_image, estimate_tag_pose=True,
+                                             camera_params=self.camera_params, tag_size=TAG_SIZE)
+
+        # pack detections into a message
+        tags_msg = AprilTagDetectionArray()
+        tags_msg.header.stamp = msg.header.stamp
+        tags_msg.header.frame_id = msg.header.frame_id
+        if detected_tags:
+            # turn all rotation matrices into quaternions in one batch
+            quats = _matrices_to_quaternions(np.stack([tag.pose_R for tag in detected_tags]))
+        for i, tag in enumerate(detected_tags):
+            q = quats[i]
+            p = tag.pose_t.T[0]
+            # create single tag detection object
+            detection = AprilTagDetection(
+                transform=Transform(
+                    translation=Vector3(x=p[0], y=p[1], z=p[2]),
+                    rotation=Quaternion(x=q[0], y=q[1], z=q[2], w=q[3]),
+                ),
+                tag_id=tag.tag_id,
+                tag_family=str(tag.tag_family),
+                hamming=tag.hamming,
+                decision_margin=tag.decision_margin,
+                pose_error=tag.pose_err,
+            )
+            if self.publish_tag_geometry:
+                detection.homography = tag.homography.ravel().tolist()
+                detection.center = tag.center.tolist()
+                detection.corners = tag.corners.ravel().tolist()
+            # add detection to array
+            tags_msg.detections.append(detection)
+        # publish detections
+        self.detections_pub.publish(tags_msg)
+
+        self.process_tags(detected_tags)
 
     def readYamlFile(self,fname):
         """
@@ -142,7 +209,7 @@ class MLNode(DTROS):
         """
         with open(fname, 'r') as in_file:
             try:
-                yaml_dict = yaml.load(in_file)
+                yaml_dict = yaml.load(in_file, Loader=YamlSafeLoader)
                 return yaml_dict
             except yaml.YAMLError as exc:
                 self.log("YAML syntax error. File: %s fname. Exc: %s"
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Shared camera intrinsics for the nodes that consume the compressed camera feed.
+
+The undistortion maps only depend on the (fixed) calibration, so they are
+computed lazily once per process and kept at module scope; every node then
+only pays for a cv2.remap per frame on whatever region it cares about.
+"""
+import cv2
+import numpy as np
+import rospkg
+import yaml
+try:
+    from yaml import CSafeLoader as YamlSafeLoader  # libyaml-backed, much faster
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
+
+_intrinsic = None
+_maps = None
+
+
+def load_intrinsics():
+    global _intrinsic
+    if _intrinsic is None:
+        fname = rospkg.RosPack().get_path('apriltag_node') + '/src/camera_intrinsic.yaml'
+        with open(fname, 'r') as in_file:
+            _intrinsic = yaml.load(in_file, Loader=YamlSafeLoader)
+    return _intrinsic
+
+
+def get_maps():
+    """
+    Returns the fixed-point (map1, map2) undistortion maps for the full frame.
+    Slice both maps by rows to remap only a region of interest.
+    """
+    global _maps
+    if _maps is None:
+        intrinsic = load_intrinsics()
+        camera_matrix = np.array(intrinsic["camera_matrix"]["data"]).reshape(3, 3)
+        distort_coeff = np.array(intrinsic["distortion_coefficients"]["data"]).reshape(5, 1)
+        width = intrinsic["image_width"]
+        height = intrinsic["image_height"]
+        newmatrix, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, distort_coeff, (width, height), 1, (width, height))
+        _maps = cv2.initUndistortRectifyMap(camera_matrix, distort_coeff, None, newmatrix,
+                                            (width, height), cv2.CV_16SC2)
+    return _maps
@@ -11,13 +11,34 @@ import cv2
 import numpy as np
 from duckietown_msgs.msg import WheelsCmdStamped, Twist2DStamped
 import os
+import sys
 import threading
 import math
+import rospkg
 import deadreckoning
 import state_machine
 
+# the undistortion maps live with the calibration file in apriltag_node
+sys.path.append(rospkg.RosPack().get_path('apriltag_node') + '/src')
+import intrinsics
+
+# the DB21 carries a Jetson Nano; offload the colour pipeline to its iGPU
+# when OpenCV was built with CUDA (the iGPU shares DRAM, so uploads are cheap)
+try:
+    # cv2.cuda.inRange only exists from OpenCV 4.5.2, so a CUDA-enabled but
+    # older build must still take the CPU path
+    HAS_CUDA = (cv2.cuda.getCudaEnabledDeviceCount() > 0
+                and hasattr(cv2.cuda, 'cvtColor')
+                and hasattr(cv2.cuda, 'inRange'))
+except (AttributeError, cv2.error):
+    HAS_CUDA = False
+
 HOST_NAME = os.environ["VEHICLE_NAME"]
 ROAD_MASK = [(20, 60, 0), (50, 255, 255)]
+STOPLINE_RED_LO = np.array([0, 70, 120], dtype=np.uint8)
+STOPLINE_RED_HI = np.array([5, 180, 255], dtype=np.uint8)
+ROI_TOP = 300  # rows above this are sky/horizon and irrelevant to lane following
+DOWNSCALE = 2  # decimation factor for the contour search; centroids scale back up linearly
 DEBUG = False
 ENGLISH = False
 STOP_TIMER_RESET_TIME = 90
@@ -33,6 +54,23 @@ class LaneFollowNode(DTROS):
         self.node_name = node_name
         self.veh = HOST_NAME
         self.jpeg = TurboJPEG()
+        # pre-sliced undistortion maps: remap only pays for the lane ROI,
+        # and the map computation itself is shared with the apriltag node
+        map1, map2 = intrinsics.get_maps()
+        self.map1_roi = np.ascontiguousarray(map1[ROI_TOP:])
+        self.map2_roi = np.ascontiguousarray(map2[ROI_TOP:])
+        # reusable per-frame buffers so the callback stops allocating
+        # a fresh HSV image and mask on every tick
+        roi_h, roi_w = self.map1_roi.shape[:2]
+        self._small_size = (roi_w // DOWNSCALE, roi_h // DOWNSCALE)
+        self._hsv_buf = np.empty((self._small_size[1], self._small_size[0], 3), np.uint8)
+        self._mask_buf = np.empty((self._small_size[1], self._small_size[0]), np.uint8)
+        self._dilate_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (10 // DOWNSCALE, 10 // DOWNSCALE))
+        if HAS_CUDA:
+            self._gpu_stream = cv2.cuda.Stream()
+            self._gpu_frame = cv2.cuda.GpuMat(self._small_size[1], self._small_size[0], cv2.CV_8UC3)
+            self._gpu_hsv = cv2.cuda.GpuMat(self._small_size[1], self._small_size[0], cv2.CV_8UC3)
+            self._gpu_mask = cv2.cuda.GpuMat(self._small_size[1], self._small_size[0], cv2.CV_8UC1)
         self.loginfo("Initialized")
 
         # PID Variables
@@ -54,7 +92,7 @@ class LaneFollowNode(DTROS):
         self.timer = 0
 
         # handling stopping at stopline
-        self.prep_turn = False  # initiate the turning when this is set to true
+        self.prep_turn = threading.Event()  # initiate the turning when this is set
         self.stop_timer_reset = 0  # 0 is can stop any time, non-zero means wait a period of time and then we look for stop lines
         self.lock = threading.Lock()  # used to coordinate the subscriber thread and the main thread
         self.controller = deadreckoning.DeadReckoning()  # will handle wheel commands during turning
@@ -120,32 +158,27 @@ class LaneFollowNode(DTROS):
         self.last_time = rospy.get_time()
 
     def is_turning(self):
-        self.lock.acquire()
-        is_turning = self.prep_turn
-        self.lock.release()
-        return is_turning
-    
+        # Event.is_set is a plain flag read, no lock round trip per call
+        return self.prep_turn.is_set()
+
     def on_stopline(self, stop_cause):
-        self.lock.acquire()
         self.stop_timer_reset = STOP_TIMER_RESET_TIME
-        self.prep_turn = True
         self.stop_cause = stop_cause
-        self.lock.release()
-    
+        # set the event last so drive() never sees it without a cause
+        self.prep_turn.set()
+
     def after_stopline(self):
-        self.lock.acquire()
+        self.prep_turn.clear()
         self.stop_cause = None
-        self.prep_turn = False
-        self.lock.release()
 
     def callback(self, msg):
         # update stop timer/timer reset and skip the callback if the vehicle is stopped
-        self.lock.acquire()
+        # (plain attribute reads/writes are atomic in CPython and the timer is
+        # approximate anyway, so no lock on this per-frame path)
         stop_timer_reset = self.stop_timer_reset
         # if self.stop_timer_reset > 0:
         #     print(self.stop_timer_reset)
         self.stop_timer_reset = max(0, stop_timer_reset - 1)
-        self.lock.release()
         if not self.bot_state.get_lane_following_flag():
             self.proportional = None
             return
@@ -153,10 +186,30 @@ class LaneFollowNode(DTROS):
         img = self.jpeg.decode(msg.data)
         flags = self.bot_state.get_flags()
 
+        # undistort + decimate the lane ROI once; the stopline check and the
+        # lane mask below share the same HSV buffer instead of each running
+        # their own cvtColor
+        crop = cv2.remap(img, self.map1_roi, self.map2_roi, cv2.INTER_LINEAR)
+        crop_width = crop.shape[1]
+        crop_small = cv2.resize(crop, self._small_size, interpolation=cv2.INTER_AREA)
+        if HAS_CUDA:
+            # HSV conversion and the lane threshold run on the iGPU; only the
+            # result buffers come back (connectedComponentsWithStats has no
+            # CUDA stats variant, so labeling stays on the CPU)
+            self._gpu_frame.upload(crop_small, self._gpu_stream)
+            cv2.cuda.cvtColor(self._gpu_frame, cv2.COLOR_BGR2HSV, dst=self._gpu_hsv, stream=self._gpu_stream)
+            cv2.cuda.inRange(self._gpu_hsv, ROAD_MASK[0], ROAD_MASK[1], dst=self._gpu_mask, stream=self._gpu_stream)
+            self._gpu_hsv.download(self._gpu_stream, self._hsv_buf)
+            self._gpu_mask.download(self._gpu_stream, self._mask_buf)
+            self._gpu_stream.waitForCompletion()
+            hsv = self._hsv_buf
+        else:
+            hsv = cv2.cvtColor(crop_small, cv2.COLOR_BGR2HSV, dst=self._hsv_buf)
+
         # print(self.bot_state.stateid, flags['is_expecting_crosswalk'])
         if flags['is_expecting_red_stopline']:
             if stop_timer_reset == 0:
-                self.red_stopline_processing(img)
+                self.red_stopline_processing(hsv)
         elif flags['is_expecting_crosswalk']:
             # two cases: crosswalk or broken duckiebot
             # test for broken duckiebot first
@@ -177,42 +230,37 @@ class LaneFollowNode(DTROS):
                 self.on_stopline(STOP_BECAUSE_CROSSWALK)
 
 
-        crop = img[300:-1, :, :]
-        crop_width = crop.shape[1]
-        hsv = cv2.cvtColor(crop, cv2.COLOR_BGR2HSV)
-        mask = cv2.inRange(hsv, ROAD_MASK[0], ROAD_MASK[1])
-        crop = cv2.bitwise_and(crop, crop, mask=mask)
-        contours, hierarchy = cv2.findContours(mask,
-                                               cv2.RETR_EXTERNAL,
-                                               cv2.CHAIN_APPROX_NONE)
-
-        # Search for lane in front
-        max_area = 20
+        if HAS_CUDA:
+            mask = self._mask_buf  # thresholded on the GPU above
+        else:
+            mask = cv2.inRange(hsv, ROAD_MASK[0], ROAD_MASK[1], dst=self._mask_buf)
+        if DEBUG:
+            debug_im = cv2.bitwise_and(crop_small, crop_small, mask=mask)
+        # one labeling pass yields areas and centroids directly, with no
+        # contour polylines or moments in between
+        nb_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+        # Search for lane in front (label 0 is the background)
+        min_area = 20 // (DOWNSCALE * DOWNSCALE)
         max_idx = -1
-        for i in range(len(contours)):
-            area = cv2.contourArea(contours[i])
-            if area > max_area:
-                max_idx = i
-                max_area = area
+        if nb_labels > 1:
+            idx = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+            if stats[idx, cv2.CC_STAT_AREA] > min_area:
+                max_idx = idx
 
         if max_idx != -1:
-            M = cv2.moments(contours[max_idx])
-            try:
-                cx = int(M['m10'] / M['m00'])
-                cy = int(M['m01'] / M['m00'])
-                threshold = 200
+            cx = int(centroids[max_idx][0]) * DOWNSCALE
+            cy = int(centroids[max_idx][1]) * DOWNSCALE
+            threshold = 200
 
-                self.proportional = min(threshold, max(-threshold, cx - int(crop_width / 2) + self.offset))
-                if DEBUG:
-                    cv2.drawContours(crop, contours, max_idx, (0, 255, 0), 3)
-                    cv2.circle(crop, (cx, cy), 7, (0, 0, 255), -1)
-            except:
-                pass
+            self.proportional = min(threshold, max(-threshold, cx - int(crop_width / 2) + self.offset))
+            if DEBUG:
+                cv2.circle(debug_im, (cx // DOWNSCALE, cy // DOWNSCALE), 7, (0, 0, 255), -1)
         else:
             self.proportional = -100 # assume off to the right
 
         if DEBUG:
-            rect_img_msg = CompressedImage(format="jpeg", data=self.jpeg.encode(crop))
+            rect_img_msg = CompressedImage(format="jpeg", data=self.jpeg.encode(debug_im))
             self.pub.publish(rect_img_msg)
 
     def drive(self):
@@ -295,33 +343,28 @@ class LaneFollowNode(DTROS):
             if not self.stop_flag:
                 self.vel_pub.publish(self.twist)
 
-    def red_stopline_processing(self, im):
-        hsv = cv2.cvtColor(im, cv2.COLOR_BGR2HSV)
-        lower_range = np.array([0,70,120])
-        upper_range = np.array([5,180,255])
-        red_mask = cv2.inRange(hsv, lower_range, upper_range)
-        img_dilation = cv2.dilate(red_mask, np.ones((10, 10), np.uint8), iterations=1)
-        contours, hierarchy = cv2.findContours(img_dilation, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-        # pick the largest contour
-        largest_area = 0
-        largest_idx = -1
-
-        for i in range(len(contours)):
-            ctn = contours[i]
-            area = cv2.contourArea(ctn)
-
-            xmin, ymin, width, height = cv2.boundingRect(ctn)
-            xmax = xmin + width
-            if area > largest_area and area > 3000 and xmax > im.shape[1] * .5 and xmin < im.shape[1] * .5:
-                largest_area = area
-                largest_idx = i
-
+    def red_stopline_processing(self, hsv):
+        # hsv is the decimated lane ROI shared with the lane mask in
+        # callback, so the pixel thresholds here are scaled by DOWNSCALE
+        # (the stopline always sits below row 390, well inside the ROI)
+        red_mask = cv2.inRange(hsv, STOPLINE_RED_LO, STOPLINE_RED_HI)
+        img_dilation = cv2.dilate(red_mask, self._dilate_kernel, iterations=1)
+        # one labeling pass gives the area and bounding box of every blob
+        nb_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(img_dilation, connectivity=8)
+
+        # pick the largest blob straddling the image midline (label 0 is the
+        # background)
         contour_y = 0
-        if largest_idx != -1:
-            largest_ctn = contours[largest_idx]
-            xmin, ymin, width, height = cv2.boundingRect(largest_ctn)
-            contour_y = ymin + height * 0.5
+        if nb_labels > 1:
+            areas = stats[1:, cv2.CC_STAT_AREA]
+            left = stats[1:, cv2.CC_STAT_LEFT]
+            right = left + stats[1:, cv2.CC_STAT_WIDTH]
+            mid = hsv.shape[1] * .5
+            valid = (areas > 3000 // (DOWNSCALE * DOWNSCALE)) & (left < mid) & (right > mid)
+            if valid.any():
+                i = 1 + int(np.argmax(np.where(valid, areas, 0)))
+                # convert back to full-frame rows for the stop threshold
+                contour_y = ROI_TOP + (stats[i, cv2.CC_STAT_TOP] + stats[i, cv2.CC_STAT_HEIGHT] * 0.5) * DOWNSCALE
 
         if contour_y > 390:
             self.on_stopline(STOP_BECAUSE_RED_STOPLINE)